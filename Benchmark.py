@@ -0,0 +1,193 @@
+import SimulatedZOSAPI
+from SimulatedZOSAPI import SimulatedClock
+import argparse
+import contextlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+# Notes
+#
+# Regression benchmarks for the workflows, run against the simulated ZOSAPI backend in SimulatedZOSAPI.py.
+# For every workflow the throughput (trials/hour), the number of COM calls, the peak memory allocated
+# by python and the latency of the main stages are recorded.
+#
+#       python Benchmark.py --save baseline.json            Run all the workflows and save the results
+#       python Benchmark.py --compare baseline.json         Run again, and report regressions against the baseline
+#
+# The time the scripts spend in time.sleep() waiting for the optimizers is not slept, it is added up
+# as simulated seconds. The throughput is based on the simulated plus the wall time, since in a real
+# campaign the time is mostly spent in those sleeps. The latency of COM calls, analyses and optimizers can be injected on the command line.
+# The backend and the random seed are deterministic, so the COM call counts should be exactly reproduced.
+
+class StageTimer(object):
+    """ Wraps methods of a class, measuring the wall time spent in each """
+
+    def __init__(self):
+        self.stages = {}
+        self.wrapped = []
+
+    def Wrap(self, cls, name):
+        original = cls.__dict__[name]
+        stage = cls.__name__ + '.' + name
+        stats = self.stages.setdefault(stage, {'calls': 0, 'totalSeconds': 0.0})
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return(original(*args, **kwargs))
+            finally:
+                stats['calls'] = stats['calls'] + 1
+                stats['totalSeconds'] = stats['totalSeconds'] + time.perf_counter() - start
+        setattr(cls, name, timed)
+        self.wrapped.append((cls, name, original))
+
+    def Restore(self):
+        for cls, name, original in self.wrapped:
+            setattr(cls, name, original)
+        self.wrapped = []
+
+    def Results(self):
+        for stats in self.stages.values():
+            stats['meanSeconds'] = stats['totalSeconds'] / max(stats['calls'], 1)
+        return(self.stages)
+
+def MisalignSystemWorkflow(trials, workDir):
+    """ The campaign of MisAlignmentGenerator.py """
+    from MisAlignmentGenerator import MisalignCampaign
+    MisalignCampaign(None, 0, trials, os.path.join(workDir, 'tmp2.zmx'), os.path.join(workDir, 'MC-alignment'))
+
+def OptimizeMTFWorkflow(trials, workDir):
+    """ OptimizeMTF, one trial is one frequency step """
+    from MtfMFGenerator import OptimizeMTF
+    OptimizeMTF(0.001, 7.0 + 0.25 * (trials - 1), 7.0, os.path.join(workDir, 'tmp2.zmx'))
+
+def PlotMtfAllConfigsWorkflow(trials, workDir):
+    """ The campaign of PlotCentralFieldMTF.py """
+    from PlotCentralFieldMTF import PlotCampaign
+    from StreamingHistos import Histos
+    histos = Histos.FromDict(PlotCampaign(None, 0, trials, os.path.join(workDir, 'MC-alignment'), workDir + os.sep))
+    histos.PlotAll(workDir + os.sep)
+
+# workflow name: (function, module, class, timed stages)
+workflows = {
+    'MisalignSystem': (MisalignSystemWorkflow, 'MisAlignmentGenerator', 'MisAlignmentGenerator',
+                       ['__init__', 'OpenFile', 'RemoveAllMtfRows', 'AddCoordinateBreaks', 'MisalignSystem', 'LocalOptimize']),
+    'OptimizeMTF': (OptimizeMTFWorkflow, 'MtfMFGenerator', 'MtfMFGenerator',
+                    ['__init__', 'OpenFile', 'RemoveAllAfterDMFS', 'OptimizeMTFGreaterThan', 'LocalOptimizeMTF', 'HammerOptimize']),
+    'PlotMtfAllConfigs': (PlotMtfAllConfigsWorkflow, 'PlotCentralFieldMTF', 'PlotCentralFieldMTF',
+                          ['__init__', 'OpenFile', 'RemoveExtremeFields', 'PlotMtfAllConfigs']),
+}
+
+def RunWorkflow(name, trials, backend, seed = 0):
+    """ Run one workflow on the simulated backend and return the measurements """
+    function, moduleName, className, stageNames = workflows[name]
+    module = __import__(moduleName)
+    cls = getattr(module, className)
+    clock = SimulatedClock()
+    module.time = clock
+    timer = StageTimer()
+    for stage in stageNames:
+        timer.Wrap(cls, stage)
+    random.seed(seed)
+    backend.Reset()
+    workDir = tempfile.mkdtemp(prefix = 'benchmark-')
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            function(trials, workDir)
+    finally:
+        wall = time.perf_counter() - start
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        timer.Restore()
+        module.time = time
+    return({'trials': trials,
+            'wallSeconds': wall,
+            'simulatedSeconds': clock.simulated,
+            'trialsPerHour': 3600.0 * trials / (clock.simulated + wall),
+            'comCalls': backend.TotalCalls(),
+            'comCallsPerTrial': float(backend.TotalCalls()) / trials,
+            'peakMemoryKB': peak / 1024.0,
+            'stages': timer.Results()})
+
+# metric: (larger is better, tolerance used if None is given)
+metrics = {'trialsPerHour': (True, None), 'simulatedSeconds': (False, 0.0), 'comCallsPerTrial': (False, 0.0), 'peakMemoryKB': (False, None)}
+
+def Compare(baseline, current, tolerance, minSeconds):
+    """ List of (workflow, metric, baseline, current, relative change, regression).
+    Stages are only reported as regressions if they are slower by more than minSeconds,
+    the very short stages are too noisy."""
+    rows = []
+    for name in sorted(current['workflows']):
+        if name not in baseline['workflows']:
+            continue
+        old = baseline['workflows'][name]
+        new = current['workflows'][name]
+        checks = [(m, old[m], new[m], larger, tol) for m, (larger, tol) in sorted(metrics.items())]
+        for stage in sorted(new['stages']):
+            if stage in old['stages']:
+                checks.append((stage, old['stages'][stage]['meanSeconds'], new['stages'][stage]['meanSeconds'], False, None))
+        for metric, oldValue, newValue, larger, tol in checks:
+            if tol is None:
+                tol = tolerance
+            if oldValue != 0:
+                change = (newValue - oldValue) / oldValue
+            elif newValue == 0:
+                change = 0.0
+            else:
+                change = float('inf')
+            worse = -change if larger else change
+            regression = worse > tol
+            if metric in new['stages'] and newValue - oldValue < minSeconds:
+                regression = False
+            rows.append((name, metric, oldValue, newValue, change, regression))
+    return(rows)
+
+def PrintReport(rows):
+    for name, metric, oldValue, newValue, change, regression in rows:
+        line = '%-18s %-45s %14.6g %14.6g %+8.1f%%' % (name, metric, oldValue, newValue, 100.0 * change)
+        if regression:
+            line = line + '  REGRESSION'
+        print(line)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmark the workflows on a simulated ZOSAPI backend')
+    parser.add_argument('workflows', nargs = '*', default = sorted(workflows), help = 'workflows to run, all if none are given')
+    parser.add_argument('--trials', type = int, default = 5)
+    parser.add_argument('--latency', type = float, default = 0.0, help = 'seconds per COM call')
+    parser.add_argument('--analysis-latency', type = float, default = 0.01, help = 'seconds per field for an MTF analysis')
+    parser.add_argument('--optimizer-latency', type = float, default = 0.01, help = 'seconds to start an optimizer')
+    parser.add_argument('--save', help = 'write the results to this json baseline')
+    parser.add_argument('--compare', help = 'compare the results to this json baseline')
+    parser.add_argument('--tolerance', type = float, default = 0.2, help = 'allowed relative change before reporting a regression')
+    parser.add_argument('--min-seconds', type = float, default = 0.005, help = 'stages slower by less than this are not regressions')
+    args = parser.parse_args()
+
+    backend = SimulatedZOSAPI.Install(args.latency, args.analysis_latency, args.optimizer_latency)
+    import matplotlib
+    matplotlib.use('Agg')
+    results = {'settings': {'trials': args.trials, 'latency': args.latency,
+                            'analysisLatency': args.analysis_latency, 'optimizerLatency': args.optimizer_latency},
+               'workflows': {}}
+    for name in args.workflows:
+        print('Running ' + name)
+        result = RunWorkflow(name, args.trials, backend)
+        results['workflows'][name] = result
+        print('  %.1f trials/hour, %d COM calls, peak memory %.0f kB' % (result['trialsPerHour'], result['comCalls'], result['peakMemoryKB']))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent = 2, sort_keys = True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['settings'] != results['settings']:
+            print('Warning: the baseline was made with different settings ' + str(baseline['settings']))
+        rows = Compare(baseline, results, args.tolerance, args.min_seconds)
+        PrintReport(rows)
+        if any(row[-1] for row in rows):
+            sys.exit(1)
@@ -0,0 +1,241 @@
+import argparse
+import json
+import os
+import sys
+# Notes
+#
+# Reduce the number of field points analysed and optimized on.
+# The subsets of field points are computed once per configuration and the fields no subset uses are
+# removed from the prepared template. The optimizer subset starts from the fields 1-5 MtfMFGenerator.py
+# has always optimized on, and the plotting subset from the central fields 2-5 PlotCentralFieldMTF.py
+# has always kept. From there they can be reduced by symmetry, if the system is known to be symmetric,
+# and by how sensitive the fields were in previous runs. Only fields with statistics can be ranked, the others,
+# like the on axis field 1, which is optimized on but never plotted, are always kept.
+# The selection is stored next to the template in <template>.fields.json, so the other scripts can
+# loop over the selected fields instead of a hard coded number of fields.
+#
+# Prepare a template (needs ZOSAPI), see --help for the options:
+#       python FieldSelector.py c:\path\tmp2.zmx [--x-symmetric] [--y-symmetric] [--histos histos.json --keep n]
+# The selection is only made once. To select again, for example with the histograms of a new campaign,
+# start from a fresh copy of the template, without a .fields.json.
+#
+# Check the ranking, without ZOSAPI:
+#       python FieldSelector.py --check
+
+def FieldKey(x, y):
+    """ Name of a field point, used to look up statistics from previous runs """
+    return('%g,%g' % (x, y))
+
+def ConfigFieldKey(config, x, y):
+    return(str(config) + ':' + FieldKey(x, y))
+
+# The fields (1-based) the scripts used before there was a field selection
+optimizeSeed = [1, 2, 3, 4, 5]
+plotSeed = [2, 3, 4, 5]
+
+class FieldSelection(object):
+    """
+    The field numbers (1-based, as in the field data editor) to optimize on and to plot for every
+    configuration (1-based). points are the (x, y) of the fields in the file, xSymmetric and ySymmetric
+    record if mirror images were removed.
+    """
+
+    def __init__(self, optimize, plot, points = None, xSymmetric = False, ySymmetric = False):
+        self.optimize = dict((int(c), sorted(f)) for c, f in optimize.items())
+        self.plot = dict((int(c), sorted(f)) for c, f in plot.items())
+        self.points = points
+        self.xSymmetric = xSymmetric
+        self.ySymmetric = ySymmetric
+
+    def OptimizeFieldsFor(self, config):
+        return(self.optimize.get(config, []))
+
+    def PlotFieldsFor(self, config):
+        return(self.plot.get(config, []))
+
+    def NumberOfOperandFields(self):
+        """ Total number of field points optimized on over all the configurations """
+        return(sum(len(f) for f in self.optimize.values()))
+
+    def Describe(self):
+        """ The plotted field points and symmetry flags, stored with the histograms to tell selections apart """
+        plot = dict((str(c), [list(self.points[n - 1]) for n in f]) for c, f in self.plot.items())
+        return({'plot': plot, 'xSymmetric': self.xSymmetric, 'ySymmetric': self.ySymmetric})
+
+    @staticmethod
+    def MetadataPath(zmxPath):
+        return(zmxPath + '.fields.json')
+
+    def Save(self, zmxPath):
+        """ Store the selection as metadata next to the lens file """
+        with open(FieldSelection.MetadataPath(zmxPath), 'w') as f:
+            json.dump({'optimize': self.optimize, 'plot': self.plot, 'points': self.points,
+                       'xSymmetric': self.xSymmetric, 'ySymmetric': self.ySymmetric}, f)
+
+    @staticmethod
+    def Load(zmxPath):
+        """ Read the selection stored for zmxPath, None if the file has no selection """
+        path = FieldSelection.MetadataPath(zmxPath)
+        if not os.path.exists(path):
+            return(None)
+        with open(path) as f:
+            d = json.load(f)
+        return(FieldSelection(d['optimize'], d['plot'], d.get('points'), d.get('xSymmetric', False), d.get('ySymmetric', False)))
+
+class FieldSelector(object):
+    """ Select a representative subset of the field points of TheSystem """
+
+    class SelectionExistsException(Exception):
+        pass
+
+    def __init__(self, theSystem):
+        self.TheSystem = theSystem
+
+    def FieldPoints(self):
+        """ List of (x, y) for all the fields in the current configuration """
+        fields = self.TheSystem.SystemData.Fields
+        points = []
+        for n in range(1, fields.NumberOfFields + 1):
+            field = fields.GetField(n)
+            points.append((field.X, field.Y))
+        return(points)
+
+    def SymmetricSubset(self, points, candidates, xSymmetric = False, ySymmetric = False):
+        """
+        The candidate field numbers with the mirror images removed.
+        If the system is symmetric around the y axis (xSymmetric), field (-x, y) gives the same MTF as (x, y).
+        Only use this for systems that are symmetric, a misaligned system is not.
+        """
+        seen = set()
+        subset = []
+        for n in candidates:
+            x, y = points[n - 1]
+            key = (abs(x) if xSymmetric else x, abs(y) if ySymmetric else y)
+            if key not in seen:
+                seen.add(key)
+                subset.append(n)
+        return(subset)
+
+    def SensitivityRanking(self, histos, config, points, candidates, quantile = 0.1):
+        """
+        Returns (ranked, unmeasured). ranked are the candidates with statistics from previous runs, most sensitive
+        first. The most sensitive fields are the ones with the lowest resolution in the quantile worst trials.
+        unmeasured are the candidates without statistics, for example field 1, which is optimized on but never plotted.
+        """
+        ranked = []
+        unmeasured = []
+        for n in candidates:
+            x, y = points[n - 1]
+            histo = histos.fields.get(ConfigFieldKey(config, x, y))
+            if histo is None or histo.entries == 0:
+                unmeasured.append(n)
+            else:
+                ranked.append((histo.Quantile(quantile), n))
+        return([n for q, n in sorted(ranked)], unmeasured)
+
+    def Reduce(self, seed, points, config, histos, nKeep, xSymmetric, ySymmetric):
+        """ Reduce the seed fields by symmetry, then keep the nKeep most sensitive of the fields with statistics.
+        The fields without statistics can not be ranked, they are all kept on top of the nKeep."""
+        subset = self.SymmetricSubset(points, [n for n in seed if n <= len(points)], xSymmetric, ySymmetric)
+        if histos is not None and nKeep is not None:
+            ranked, unmeasured = self.SensitivityRanking(histos, config, points, subset)
+            subset = sorted(ranked[:nKeep] + unmeasured)
+        return(subset)
+
+    def Select(self, histos = None, nKeep = None, xSymmetric = False, ySymmetric = False):
+        """ Compute the selection for all configurations in the MCE """
+        mce = self.TheSystem.MCE
+        optimize = {}
+        plot = {}
+        for mc in range(mce.NumberOfConfigurations):
+            mce.SetCurrentConfiguration(mc + 1)
+            points = self.FieldPoints()
+            optimize[mc + 1] = self.Reduce(optimizeSeed, points, mc + 1, histos, nKeep, xSymmetric, ySymmetric)
+            plot[mc + 1] = self.Reduce(plotSeed, points, mc + 1, histos, nKeep, xSymmetric, ySymmetric)
+        return(FieldSelection(optimize, plot, None, xSymmetric, ySymmetric))
+
+    def Apply(self, selection, plotOnly = False):
+        """
+        Remove the fields not used by any configuration, and return the selection renumbered
+        to the remaining fields. If plotOnly, the fields only used for optimizing are removed too.
+        """
+        used = set()
+        for subset in selection.plot.values():
+            used.update(subset)
+        if not plotOnly:
+            for subset in selection.optimize.values():
+                used.update(subset)
+        fields = self.TheSystem.SystemData.Fields
+        nFields = fields.NumberOfFields
+        for n in range(nFields, 0, -1):
+            if n not in used:
+                fields.RemoveField(n)
+        newNumber = dict((old, new + 1) for new, old in enumerate(sorted(used)))
+        def renumber(subsets):
+            return(dict((c, [newNumber[n] for n in subset if n in newNumber]) for c, subset in subsets.items()))
+        return(FieldSelection(renumber(selection.optimize), renumber(selection.plot), self.FieldPoints(),
+                              selection.xSymmetric, selection.ySymmetric))
+
+def PrepareTemplate(zosapi, fname, histos = None, nKeep = None, xSymmetric = False, ySymmetric = False):
+    """ Select fields in the lens file fname, remove the others and save the file with the selection as metadata """
+    selection = FieldSelection.Load(fname)
+    if selection is not None:
+        if histos is not None or xSymmetric or ySymmetric:
+            raise FieldSelector.SelectionExistsException("Fields are already selected in " + fname +
+                                                         ", start from a fresh copy of the template to select again")
+        print('Field selection already applied to ' + fname)
+        return(selection)
+    zosapi.OpenFile(fname, False)
+    selector = FieldSelector(zosapi.TheSystem)
+    selection = selector.Apply(selector.Select(histos, nKeep, xSymmetric, ySymmetric))
+    zosapi.TheSystem.SaveAs(fname)
+    selection.Save(fname)
+    print('Selected fields, optimize ' + str(selection.optimize) + ' plot ' + str(selection.plot))
+    return(selection)
+
+def _CheckSensitivityRanking():
+    """ The worst measured field must always be selected, whatever the fields without statistics """
+    from StreamingHistos import Histos
+    points = [(0.0, 0.0), (0.0, 5.0), (0.0, -5.0), (5.0, 0.0), (-5.0, 0.0)]
+    selector = FieldSelector(None)
+    for measured in [[2, 3, 4, 5], [3, 4], [5]]:
+        histos = Histos()
+        for n in measured:
+            x, y = points[n - 1]
+            for i in range(10):
+                histos.FillField(ConfigFieldKey(1, x, y), 4.0 + n + 0.1 * i)
+        worst = min(measured)
+        for nKeep in [1, 2]:
+            for seed in [optimizeSeed, plotSeed]:
+                subset = selector.Reduce(seed, points, 1, histos, nKeep, False, False)
+                unmeasured = [n for n in seed if n not in measured]
+                assert worst in subset, (measured, nKeep, seed, subset)
+                assert subset == sorted(unmeasured + sorted(measured)[:nKeep]), (measured, nKeep, seed, subset)
+    print('OK _CheckSensitivityRanking')
+
+if __name__ == '__main__':
+    """Make sure the template is a copy, the removed fields are lost"""
+    parser = argparse.ArgumentParser(description = 'Select the field points of a template, once')
+    parser.add_argument('template', nargs = '?')
+    parser.add_argument('--x-symmetric', action = 'store_true', help = 'the system is symmetric around the y axis, (-x, y) is the same as (x, y)')
+    parser.add_argument('--y-symmetric', action = 'store_true', help = 'the system is symmetric around the x axis, (x, -y) is the same as (x, y)')
+    parser.add_argument('--histos', help = 'histograms of a previous run, for ranking the fields by sensitivity')
+    parser.add_argument('--keep', type = int, help = 'number of most sensitive fields to keep per configuration, with --histos. Fields without statistics are kept as well')
+    parser.add_argument('--check', action = 'store_true', help = 'check the sensitivity ranking and exit')
+    args = parser.parse_args()
+    if args.check:
+        _CheckSensitivityRanking()
+        sys.exit(0)
+    if args.template is None:
+        parser.error('the template is required')
+    if (args.histos is None) != (args.keep is None):
+        parser.error('--histos and --keep go together')
+
+    from MtfMFGenerator import MtfMFGenerator
+    from StreamingHistos import Histos
+    histos = None
+    if args.histos is not None:
+        histos = Histos.Load(args.histos)
+    zosapi = MtfMFGenerator()
+    PrepareTemplate(zosapi, args.template, histos, args.keep, args.x_symmetric, args.y_symmetric)
+    del zosapi
@@ -3,6 +3,9 @@ from win32com.client import CastTo, constants
 import matplotlib.pyplot as plt
 import time
 import random
+from FieldSelector import FieldSelection
+from Watchdog import SessionWatchdog, Job
+import Watchdog
 # Notes
 #
 # The python project and script was tested with the following tools:
@@ -43,7 +46,7 @@ class MisAlignmentGenerator(object):
         if self.TheConnection is None:
             raise MisAlignmentGenerator.ConnectionException("Unable to intialize COM connection to ZOSAPI")
 
-        self.TheApplication = self.TheConnection.CreateNewApplication()
+        self.TheApplication = Watchdog.CreateApplication(self.TheConnection)
         if self.TheApplication is None:
             raise MisAlignmentGenerator.InitializationException("Unable to acquire ZOSAPI application")
 
@@ -57,7 +60,7 @@ class MisAlignmentGenerator(object):
     def __del__(self):
         """Boiler plate"""
         if self.TheApplication is not None:
-            self.TheApplication.CloseApplication()
+            Watchdog.CloseApplication(self.TheApplication)
             self.TheApplication = None
 
         self.TheConnection = None
@@ -175,6 +178,7 @@ REAXp is true if we are aiming in x, false if we are aiming in y
         counter = 0
         print("Starting loop, mf = " + str(mf))
         while mf > target:
+            Watchdog.Heartbeat('LocalOptimize', 120)
             time.sleep(6)
             mf = lopt.CurrentMeritFunction
             print("mf = " + str(mf))
@@ -269,19 +273,35 @@ REAXp is true if we are aiming in x, false if we are aiming in y
             
         self.LocalOptimize(0.00000001)        
           
-if __name__ == '__main__':
-    #Make sure paths are ok before running
+def MisalignCampaign(checkpoint, first, last, template, outPrefix):
+    """ Make the misaligned systems first to last - 1 from template.
+    Run as a Watchdog job, the checkpoint is the number of the next system to make.
+    The field selection of the template, if any, is copied to every misaligned system.
+    """
     # I have to open a ZOSAPI instance for every turn, or else it fails eventually
     # This slows down the process a whole lot
-    for i in range(0,100):
+    selection = FieldSelection.Load(template)
+    start = first if checkpoint is None else checkpoint
+    for i in range(start, last):
+        Watchdog.Heartbeat('Misaligning system ' + str(i))
         zosapi = MisAlignmentGenerator()
         print("Misaligning system " + str(i))
-        zosapi.OpenFile('c:\\Users\haavagj\\tmp2.zmx', False)
+        zosapi.OpenFile(template, False)
         zosapi.RemoveAllMtfRows()
         zosapi.RemoveAllVariables()
         surfList = zosapi.ListMirrorPlanes()
         print(surfList)
         zosapi.AddCoordinateBreaks()
         zosapi.MisalignSystem(0.25,0.25,1)
-        zosapi.TheSystem.SaveAs('c:\\Users\haavagj\\MC-alignment' + str(i) + '.zmx')
+        zosapi.TheSystem.SaveAs(outPrefix + str(i) + '.zmx')
+        if selection is not None:
+            selection.Save(outPrefix + str(i) + '.zmx')
         del zosapi
+        Watchdog.Checkpoint(i + 1)
+
+if __name__ == '__main__':
+    #Make sure paths are ok before running
+    # The campaign runs in a worker process that is restarted from the last saved system if it hangs.
+    # The checkpoint file is removed when the campaign is done. Delete it to start an interrupted campaign over.
+    watchdog = SessionWatchdog(checkpointFile = 'c:\\Users\haavagj\\MC-alignment-checkpoint.json')
+    watchdog.Run([Job('MC-alignment', MisalignCampaign, (0, 100, 'c:\\Users\haavagj\\tmp2.zmx', 'c:\\Users\haavagj\\MC-alignment'))])
@@ -2,6 +2,9 @@ from win32com.client.gencache import EnsureDispatch, EnsureModule
 from win32com.client import CastTo, constants
 import matplotlib.pyplot as plt
 import time
+from FieldSelector import FieldSelection
+from Watchdog import SessionWatchdog, Job
+import Watchdog
 # Notes
 #
 # The python project and script was tested with the following tools:
@@ -42,7 +45,7 @@ class MtfMFGenerator(object):
         if self.TheConnection is None:
             raise MtfMFGenerator.ConnectionException("Unable to intialize COM connection to ZOSAPI")
 
-        self.TheApplication = self.TheConnection.CreateNewApplication()
+        self.TheApplication = Watchdog.CreateApplication(self.TheConnection)
         if self.TheApplication is None:
             raise MtfMFGenerator.InitializationException("Unable to acquire ZOSAPI application")
 
@@ -56,7 +59,7 @@ class MtfMFGenerator(object):
     def __del__(self):
         """Boiler plate"""
         if self.TheApplication is not None:
-            self.TheApplication.CloseApplication()
+            Watchdog.CloseApplication(self.TheApplication)
             self.TheApplication = None
 
         self.TheConnection = None
@@ -129,19 +132,26 @@ class MtfMFGenerator(object):
         p1 = opgt.GetOperandCell(constants.MeritColumn_Param1)
         p1.IntegerValue = CastTo(mtf,'IEditorRow').RowIndex + 1
         
-    def OptimizeMTFGreaterThan(self, nFields, freq, target):
+    def OptimizeMTFGreaterThan(self, nFields, freq, target, selection = None):
         """
         Create MF to optimize on MTF for the nFields first field points, trying to make it greater than target at freq. 
+        If a FieldSelection is given, the fields selected for optimizing in each configuration are used instead of the nFields first,
+        and configurations without selected fields are skipped.
         Operands will be added to the end of the merit function.
         """
         mce = self.TheSystem.MCE
         mcs = mce.NumberOfConfigurations
         for mc in range(mcs):
+            if selection is None:
+                fields = range(nFields)
+            else:
+                fields = [f - 1 for f in selection.OptimizeFieldsFor(mc + 1)]
+                if len(fields) == 0: continue
             mfe = self.TheSystem.MFE
             cnf = mfe.AddOperand()
             cnf.ChangeType(constants.MeritOperandType_CONF)
             cnf.GetOperandCell(constants.MeritColumn_Param1).IntegerValue = mc + 1
-            for f in range(nFields):
+            for f in fields:
                 self.AddMTFOPGT(f, freq, target, constants.MeritOperandType_GMTS)
                 self.AddMTFOPGT(f, freq, target, constants.MeritOperandType_GMTT)
 
@@ -161,6 +171,7 @@ class MtfMFGenerator(object):
         dcount = 0
         print("Starting loop, mf = " + str(mf))
         while mf > target:
+            Watchdog.Heartbeat('LocalOptimizeMTF', 300)
             time.sleep(60)
             if (lopt.CurrentMeritFunction < mf):
                 dcount = 0
@@ -190,6 +201,7 @@ class MtfMFGenerator(object):
         print("Starting loop, mf = " + str(mf))
         iter = 0
         while mf > target:
+            Watchdog.Heartbeat('HammerOptimize', 1200)
             time.sleep(600)
             mf = hopt.CurrentMeritFunction
             print("Time " + str(iter))
@@ -199,7 +211,7 @@ class MtfMFGenerator(object):
         CastTo(hopt, "ISystemTool").Close()
         return(mf)
     
-def OptimizeMTF(target, maxfreq, startfreq, fname):
+def OptimizeMTF(target, maxfreq, startfreq, fname, checkpoint = None):
     """Optimize on MTF for increasing frequency, first using local optimization, then hammer.
 
     Merit function requires GMTS and GMTT to be above 0.5 for all
@@ -209,36 +221,59 @@ def OptimizeMTF(target, maxfreq, startfreq, fname):
     Starting Hammer optimization after local optimization hangs the ZOSAPI connection, I do not know why. 
     for This reason, the ZOSAPI connection is opened and closed for every optimizer.
 
+    If the file has a field selection (see FieldSelector.py), only the selected fields are optimized on.
+
+    After every optimizer a Watchdog checkpoint with the frequency and whether only hammer is left is made.
+    Given such a checkpoint, the optimization continues from there.
+
     Kill with ctrl+c in powershell
     """
+    selection = FieldSelection.Load(fname)
     freq = startfreq
+    hammerOnly = False
+    if checkpoint is not None:
+        freq = checkpoint['freq']
+        hammerOnly = checkpoint['hammer']
     while freq <= maxfreq:
-        #Set up for local optimization
-        print('Preparing for freq ' + str(freq))
-        zosapi = MtfMFGenerator()
-        value = zosapi.ExampleConstants()
-        zosapi.OpenFile(fname,False)
-        zosapi.RemoveAllAfterDMFS()
-        zosapi.OptimizeMTFGreaterThan(5, freq, 0.5)
-        mf = zosapi.LocalOptimizeMTF(target)
-        zosapi.TheSystem.SaveAs(fname)
-        del zosapi
-        print('MF after local optimization is ' + str(mf))
+        if not hammerOnly:
+            #Set up for local optimization
+            print('Preparing for freq ' + str(freq))
+            Watchdog.Heartbeat('Preparing local optimization')
+            zosapi = MtfMFGenerator()
+            value = zosapi.ExampleConstants()
+            zosapi.OpenFile(fname,False)
+            zosapi.RemoveAllAfterDMFS()
+            zosapi.OptimizeMTFGreaterThan(5, freq, 0.5, selection)
+            mf = zosapi.LocalOptimizeMTF(target)
+            zosapi.TheSystem.SaveAs(fname)
+            del zosapi
+            print('MF after local optimization is ' + str(mf))
+            Watchdog.Checkpoint({'freq': freq, 'hammer': True})
+        hammerOnly = False
 
         #Global optimization
+        Watchdog.Heartbeat('Preparing hammer optimization')
         zosapi = MtfMFGenerator()
         value = zosapi.ExampleConstants()
         zosapi.OpenFile(fname,False)
         zosapi.RemoveAllAfterDMFS();
-        zosapi.OptimizeMTFGreaterThan(5, freq, 0.5)
+        zosapi.OptimizeMTFGreaterThan(5, freq, 0.5, selection)
         zosapi.HammerOptimize(target)
         zosapi.TheSystem.SaveAs(fname)
         del zosapi
         freq = freq + 0.25
+        Watchdog.Checkpoint({'freq': freq, 'hammer': False})
+
+def OptimizeMTFJob(checkpoint, target, maxfreq, startfreq, fname):
+    """ OptimizeMTF as a Watchdog job """
+    OptimizeMTF(target, maxfreq, startfreq, fname, checkpoint)
         
 if __name__ == '__main__':
     #Make sure paths are ok before running
     # Insert Code Here
     # Open file
-    OptimizeMTF(0.001, 13, 7.0, 'c:\\Users\\haavagj\\tmp2.zmx')
+    # The optimization runs in a worker process that is restarted from the last saved step if it hangs.
+    # The checkpoint file is removed when the optimization is done. Delete it to start an interrupted optimization over.
+    watchdog = SessionWatchdog(checkpointFile = 'c:\\Users\\haavagj\\tmp2-checkpoint.json')
+    watchdog.Run([Job('OptimizeMTF', OptimizeMTFJob, (0.001, 13, 7.0, 'c:\\Users\\haavagj\\tmp2.zmx'))])
 
@@ -4,6 +4,11 @@ import matplotlib.pyplot as plt
 import time
 from array import array
 from math import floor
+from StreamingHistos import Histos
+from FieldSelector import FieldSelection, FieldSelector, ConfigFieldKey
+import sys
+from Watchdog import SessionWatchdog, Job
+import Watchdog
 # Notes
 #
 # The python project and script was tested with the following tools:
@@ -13,26 +18,6 @@ from math import floor
 #       Python Tools for Visual Studio (https://pytools.codeplex.com/) - integration into Visual Studio
 #
 # Note that Visual Studio and Python Tools make development easier, however this python script should should run without either installed.
-class Histos:
-    def __init__(self):
-        self.resolutions = []
-        self.histos5 = [[],[],[]]
-        self.histos75 = [[],[],[]]
-        self.histos10 = [[],[],[]]
-
-    def FillCounterHisto(self, histos, counter):
-        for i in range(3):
-            histos[i].append(counter[i])
-
-    def PlotHistos(self, path, bname, histos):
-        typeNames = ["tangential","sagittal","average"]
-        for i in range(3):
-            fig,ax = plt.subplots(1,1,figsize=(8,6))
-            plt.hist(histos[i])
-            plt.grid()
-            fig.savefig(path + bname + '-' + typeNames[i] + '.png')
-            plt.close(fig)
-            
 class PlotCentralFieldMTF(object):
 
     class LicenseException(Exception):
@@ -64,7 +49,7 @@ class PlotCentralFieldMTF(object):
         if self.TheConnection is None:
             raise PlotCentralFieldMTF.ConnectionException("Unable to intialize COM connection to ZOSAPI")
 
-        self.TheApplication = self.TheConnection.CreateNewApplication()
+        self.TheApplication = Watchdog.CreateApplication(self.TheConnection)
         if self.TheApplication is None:
             raise PlotCentralFieldMTF.InitializationException("Unable to acquire ZOSAPI application")
 
@@ -77,7 +62,7 @@ class PlotCentralFieldMTF(object):
 
     def __del__(self):
         if self.TheApplication is not None:
-            self.TheApplication.CloseApplication()
+            Watchdog.CloseApplication(self.TheApplication)
             self.TheApplication = None
 
         self.TheConnection = None
@@ -122,7 +107,7 @@ class PlotCentralFieldMTF(object):
                 lim = xdata.Data[i]
                 resolution = xdata.Data[i]
                 break
-        histos.resolutions.append(20)
+        histos.resolutions.Fill(resolution)
         return(resolution)
 
     def CornerCounter (self,res, index, h5, h75, h10):
@@ -133,12 +118,16 @@ class PlotCentralFieldMTF(object):
         if res > 10.0:
             h10[index] = 1 + h10[index]
             
-    def PlotMtfAllConfigs(self, bname, histos):
-        """Loop over all configs in MCE, and plot the MTF for all active fields"""
+    def PlotMtfAllConfigs(self, bname, histos, selection = None, plotDir = 'c:\\Users\\haavagj\\plots\\'):
+        """Loop over all configs in MCE, and plot the MTF for all active fields to plotDir.
+        If a FieldSelection is given, only the fields selected for the config are plotted and counted.
+        The field points, for the statistics per field, are taken from the selection, or read once per file without one."""
         mce = self.TheSystem.MCE
         mcs = mce.NumberOfConfigurations
+        points = None if selection is None else selection.points
         #Loop over all configs
         for mc in range(mcs):
+            if selection is not None and len(selection.PlotFieldsFor(mc + 1)) == 0: continue
             mce.SetCurrentConfiguration(mc + 1)
             
             #Plot MTF
@@ -146,6 +135,7 @@ class PlotCentralFieldMTF(object):
             settings = CastTo( gmtf.GetSettings(), 'IAS_GeometricMtf' )
             #settings.ShowDiffractionLimit()
             settings.MaximumFrequency = 20.0
+            Watchdog.Heartbeat('GeometricMtf config ' + str(mc + 1))
             gmtf.ApplyAndWaitForCompletion()
             #gmtf.ToFile('m:\\gmtf.txt')
             results = gmtf.GetResults()
@@ -157,6 +147,7 @@ class PlotCentralFieldMTF(object):
 
             #Loop over results.
             for i in range(results.NumberOfDataSeries):
+                if selection is not None and (i + 1) not in selection.PlotFieldsFor(mc + 1): continue
                 ds = results.GetDataSeries(i)
                 plt.plot(ds.XData.Data,ds.YData.Data)
                 resT = self.CheckLimits(ds.XData, ds.YData, 0, histos) #Tangential (or opposite)
@@ -164,38 +155,74 @@ class PlotCentralFieldMTF(object):
                 self.CornerCounter (resT, 0, res5, res75, res10)
                 self.CornerCounter (resS, 1, res5, res75, res10)
                 self.CornerCounter ((resT + resS)/2.0, 2, res5, res75, res10)
+                if points is None:
+                    points = FieldSelector(self.TheSystem).FieldPoints()
+                x, y = points[i]
+                histos.FillField(ConfigFieldKey(mc + 1, x, y), (resT + resS)/2.0)
                 
             histos.FillCounterHisto(histos.histos5 , res5)
             histos.FillCounterHisto(histos.histos75, res75)
             histos.FillCounterHisto(histos.histos10, res10)
             plt.grid()
-            fig.savefig('c:\\Users\\haavagj\\plots\\' + bname  + str(mc) + '.png')
+            fig.savefig(plotDir + bname  + str(mc) + '.png')
             plt.close(fig)    
         
-if __name__ == '__main__':
-    """Reads file m:/tmp2.zmx, removes fields and plots the MTF for the central fields
-    Make sure the paths for the plots and the input file are ok before running"""
+def PlotCampaign(checkpoint, first, last, inPrefix, plotDir):
+    """Plot the MTF of the files inPrefix + first to last - 1, and return the filled histograms as a dict.
+    Run as a Watchdog job, the checkpoint is the next file and the histograms filled so far.
+    Files with a field selection (see FieldSelector.py) only keep the fields selected for plotting, instead of the central fields.
+    All the files must have the same selection, or none, and the histograms record which."""
     histos = Histos()
-    print(histos.resolutions)
+    start = first
+    if checkpoint is not None:
+        start = checkpoint['next']
+        histos = Histos.FromDict(checkpoint['histos'])
 
-    for i in range(0,100):
+    for i in range(start, last):
         print('MC-alignment' + str(i))
+        Watchdog.Heartbeat('Plotting ' + str(i))
         zosapi = PlotCentralFieldMTF()
         value = zosapi.ExampleConstants()
-        zosapi.OpenFile('c:\\Users\\haavagj\\MC-alignment' + str(i) + '.zmx',False)
-        zosapi.RemoveExtremeFields()
-        zosapi.PlotMtfAllConfigs('mtf' + str(i), histos)
+        fname = inPrefix + str(i) + '.zmx'
+        zosapi.OpenFile(fname,False)
+        selection = FieldSelection.Load(fname)
+        description = None
+        if selection is None:
+            zosapi.RemoveExtremeFields()
+        else:
+            description = selection.Describe()
+            selection = FieldSelector(zosapi.TheSystem).Apply(selection, plotOnly = True)
+        if i == first:
+            histos.selection = description
+        elif histos.selection != description:
+            raise Histos.MergeException(fname + " has a different field selection than " + inPrefix + str(first) + '.zmx')
+        zosapi.PlotMtfAllConfigs('mtf' + str(i), histos, selection, plotDir)
     
         # This will clean up the connection to OpticStudio.
         # Note that it closes down the server instance of OpticStudio, so you for maximum performance do not do
         # this until you need to.
         del zosapi
-    histos.PlotHistos('c:\\Users\\haavagj\\plots\\', "corners-mtf5",  histos.histos5)
-    histos.PlotHistos('c:\\Users\\haavagj\\plots\\', "corners-mtf75", histos.histos75)
-    histos.PlotHistos('c:\\Users\\haavagj\\plots\\', "corners-mtf10", histos.histos10)
-    fig,ax = plt.subplots(1,1,figsize=(8,6)) 
-    plt.hist(histos.resolutions)
-    plt.grid()
-    fig.savefig('c:\\Users\\haavagj\\plots\\mtf-resolution.png')
-    plt.close(fig)
-    
+        Watchdog.Checkpoint({'next': i + 1, 'histos': histos.ToDict()})
+    return(histos.ToDict())
+
+if __name__ == '__main__':
+    """Reads file m:/tmp2.zmx, removes fields and plots the MTF for the central fields
+    Make sure the paths for the plots and the input file are ok before running
+
+    Optional arguments first and last trial make it possible to split the campaign over several processes.
+    The histograms are saved to a json file, partial results are merged with StreamingHistos.py
+    The plotting runs in a worker process that is restarted from the last plotted file if it hangs.
+    The checkpoint file is removed when the job is done. Delete it to start an interrupted job over."""
+    first = 0
+    last = 100
+    if len(sys.argv) > 2:
+        first = int(sys.argv[1])
+        last = int(sys.argv[2])
+
+    plotDir = 'c:\\Users\\haavagj\\plots\\'
+    name = 'histos-' + str(first) + '-' + str(last)
+    watchdog = SessionWatchdog(checkpointFile = plotDir + name + '-checkpoint.json')
+    results = watchdog.Run([Job(name, PlotCampaign, (first, last, 'c:\\Users\\haavagj\\MC-alignment', plotDir))])
+    histos = Histos.FromDict(results[name])
+    histos.Save(plotDir + name + '.json')
+    histos.PlotAll(plotDir)
@@ -0,0 +1,439 @@
+import importlib
+import os
+import subprocess
+import sys
+import time
+import types
+from math import exp
+# Notes
+#
+# A deterministic stand in for the parts of ZOSAPI used by the scripts in this project, so the
+# workflows can be run and measured without OpticStudio (see Benchmark.py).
+#
+# Install() puts fake win32com modules in sys.modules. It must be called before any of the
+# scripts are imported. Every access to a public attribute of a simulated object counts as one
+# COM call, and sleeps for the injected latency.
+#
+# The backend can be told to hang on the n-th call to a COM method or property, for example
+# hangOn = {'Optimizer.CurrentMeritFunction': 10}, to test the Watchdog. With launchProcess every
+# application starts a sleeping process standing in for OpticStudio, which the Watchdog should kill.
+
+class Backend(object):
+    """ Settings and counters shared by all the simulated objects """
+
+    def __init__(self, latency = 0.0, analysisLatency = 0.0, optimizerLatency = 0.0, mfDecay = 0.5, nConfigs = 3, hangOn = None, launchProcess = False):
+        self.latency = latency
+        self.hangOn = hangOn or {}
+        self.launchProcess = launchProcess
+        self.analysisLatency = analysisLatency
+        self.optimizerLatency = optimizerLatency
+        self.mfDecay = mfDecay
+        self.nConfigs = nConfigs
+        self.Reset()
+
+    def Reset(self):
+        self.calls = {}
+        self.saved = []
+
+    def Call(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.hangOn.get(name) == self.calls[name]:
+            while True:
+                time.sleep(1)
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def TotalCalls(self):
+        return(sum(self.calls.values()))
+
+backend = Backend()
+
+class _SimObject(object):
+    """ Base class, counts every public attribute access as a COM call.
+    Setting an attribute for the first time, in the constructor, is not counted."""
+
+    def __getattribute__(self, name):
+        if not name.startswith('_'):
+            backend.Call(type(self).__name__ + '.' + name)
+        return(object.__getattribute__(self, name))
+
+    def __setattr__(self, name, value):
+        if not name.startswith('_') and name in object.__getattribute__(self, '__dict__'):
+            backend.Call(type(self).__name__ + '.' + name)
+        object.__setattr__(self, name, value)
+
+class _Constants(object):
+    """ constants.X is the string 'X' """
+
+    def __init__(self):
+        self._names = {}
+
+    def __getattr__(self, name):
+        return(self._names.setdefault(name, name))
+
+constants = _Constants()
+
+def _Peek(obj, name):
+    """ Read an attribute without counting it as a COM call """
+    return(object.__getattribute__(obj, name))
+
+def CastTo(obj, interface):
+    """ The simulated objects implement all the interfaces """
+    return(obj)
+
+class Cell(_SimObject):
+    def __init__(self):
+        self.IntegerValue = 0
+        self.DoubleValue = 0.0
+        self._variable = False
+        self._solve = None
+
+    def MakeSolveVariable(self):
+        self._variable = True
+
+    def CreateSolveType(self, solveType):
+        solve = Solve()
+        solve._S_SurfacePickup = Pickup()
+        return(solve)
+
+    def SetSolveData(self, data):
+        self._solve = data
+
+class Solve(_SimObject):
+    pass
+
+class Pickup(_SimObject):
+    def __init__(self):
+        self.ScaleFactor = 1.0
+        self.Surface = 0
+
+class Surface(_SimObject):
+    def __init__(self, thickness, material, semiDiameter):
+        self.Thickness = thickness
+        self.Material = material
+        self.SemiDiameter = semiDiameter
+        self._type = constants.SurfaceType_Standard
+        self._cells = {}
+
+    def GetSurfaceTypeSettings(self, surfaceType):
+        return(surfaceType)
+
+    def ChangeType(self, settings):
+        self._type = settings
+
+    def GetCellAt(self, index):
+        return(self._cells.setdefault(index, Cell()))
+
+    def GetSurfaceCell(self, column):
+        return(self._cells.setdefault(column, Cell()))
+
+class LDE(_SimObject):
+    # (thickness, material, semi diameter) of the template system
+    template = [(1000.0, '', 0.0), (200.0, '', 10.0), (-300.0, 'MIRROR', 40.0), (400.0, 'MIRROR', 40.0),
+                (-350.0, 'MIRROR', 50.0), (300.0, '', 20.0), (0.0, '', 15.0)]
+
+    def __init__(self):
+        self._surfaces = [Surface(t, m, d) for t, m, d in LDE.template]
+        self.StopSurface = 1
+
+    @property
+    def NumberOfSurfaces(self):
+        return(len(self._surfaces))
+
+    def GetSurfaceAt(self, index):
+        return(self._surfaces[index])
+
+    def GetRowAt(self, index):
+        return(self._surfaces[index])
+
+    def InsertNewSurfaceAt(self, index):
+        self._surfaces.insert(index, Surface(0.0, '', 0.0))
+        if index <= _Peek(self, 'StopSurface'):
+            object.__setattr__(self, 'StopSurface', _Peek(self, 'StopSurface') + 1)
+
+class Operand(_SimObject):
+    def __init__(self, mfe, operandType):
+        self._mfe = mfe
+        self.Type = operandType
+        self.Target = 0.0
+        self._cells = {}
+
+    def ChangeType(self, operandType):
+        self.Type = operandType
+
+    def GetOperandCell(self, column):
+        return(self._cells.setdefault(column, Cell()))
+
+    @property
+    def RowIndex(self):
+        return(self._mfe._operands.index(self))
+
+class MFE(_SimObject):
+    def __init__(self):
+        self._operands = []
+        self._operands.append(Operand(self, constants.MeritOperandType_BLNK))
+        self._operands.append(Operand(self, constants.MeritOperandType_DMFS))
+
+    @property
+    def NumberOfOperands(self):
+        return(len(self._operands))
+
+    def AddOperand(self):
+        op = Operand(self, constants.MeritOperandType_BLNK)
+        self._operands.append(op)
+        return(op)
+
+    def GetOperandAt(self, index):
+        return(self._operands[index])
+
+    def DeleteRowsAt(self, index, count):
+        del self._operands[index:index + count]
+
+class MCE(_SimObject):
+    def __init__(self, nConfigs):
+        self.NumberOfConfigurations = nConfigs
+        self._current = 1
+
+    def SetCurrentConfiguration(self, config):
+        self._current = config
+
+class Field(_SimObject):
+    def __init__(self, x, y):
+        self.X = x
+        self.Y = y
+
+class Fields(_SimObject):
+    template = [(0.0, 0.0), (0.0, 5.0), (0.0, -5.0), (5.0, 0.0), (-5.0, 0.0),
+                (5.0, 5.0), (-5.0, 5.0), (5.0, -5.0), (-5.0, -5.0)]
+
+    def __init__(self):
+        self._fields = [Field(x, y) for x, y in Fields.template]
+
+    @property
+    def NumberOfFields(self):
+        return(len(self._fields))
+
+    def GetField(self, number):
+        return(self._fields[number - 1])
+
+    def RemoveField(self, number):
+        del self._fields[number - 1]
+
+class SystemData(_SimObject):
+    def __init__(self):
+        self.Fields = Fields()
+
+class Optimizer(_SimObject):
+    """ The merit function decreases by mfDecay every time it is read """
+
+    def __init__(self):
+        self.Algorithm = None
+        self.Cycles = None
+        self.NumberOfCores = 1
+        self._mf = 1.0
+
+    def Run(self):
+        if backend.optimizerLatency > 0:
+            time.sleep(backend.optimizerLatency)
+
+    def Cancel(self):
+        pass
+
+    def Close(self):
+        pass
+
+    @property
+    def InitialMeritFunction(self):
+        return(1.0)
+
+    @property
+    def CurrentMeritFunction(self):
+        self._mf = self._mf * backend.mfDecay
+        return(self._mf)
+
+class Tools(_SimObject):
+    def OpenLocalOptimization(self):
+        return(Optimizer())
+
+    def OpenHammerOptimization(self):
+        return(Optimizer())
+
+    def RemoveAllVariables(self):
+        return(True)
+
+class Data(_SimObject):
+    def __init__(self, data):
+        self.Data = data
+        self.Length = len(data)
+
+class DataSeries(_SimObject):
+    def __init__(self, xdata, ydata):
+        self.XData = Data(xdata)
+        self.YData = Data(ydata)
+
+class Results(_SimObject):
+    def __init__(self, system, maxFreq):
+        fields = _Peek(system._systemData, 'Fields')._fields
+        config = system._mce._current
+        freqs = [maxFreq * i / 40.0 for i in range(41)]
+        self._series = []
+        for n, f in enumerate(fields):
+            # MTF falls off faster for field points far from the axis
+            scaleT = 12.0 / (1.0 + 0.05 * abs(_Peek(f, 'Y')) + 0.1 * config)
+            scaleS = 12.0 / (1.0 + 0.05 * abs(_Peek(f, 'X')) + 0.1 * config)
+            ydata = [(exp(-x / scaleT), exp(-x / scaleS)) for x in freqs]
+            self._series.append(DataSeries(tuple(freqs), ydata))
+        self.NumberOfDataSeries = len(self._series)
+
+    def GetDataSeries(self, index):
+        return(self._series[index])
+
+class GeometricMtfSettings(_SimObject):
+    def __init__(self):
+        self.MaximumFrequency = 10.0
+
+class GeometricMtf(_SimObject):
+    def __init__(self, system):
+        self._system = system
+        self._settings = GeometricMtfSettings()
+        self._results = None
+
+    def GetSettings(self):
+        return(self._settings)
+
+    def ApplyAndWaitForCompletion(self):
+        if backend.analysisLatency > 0:
+            time.sleep(backend.analysisLatency * len(_Peek(self._system._systemData, 'Fields')._fields))
+        self._results = Results(self._system, _Peek(self._settings, 'MaximumFrequency'))
+
+    def GetResults(self):
+        return(self._results)
+
+class Analyses(_SimObject):
+    def __init__(self, system):
+        self._system = system
+
+    def New_GeometricMtf(self):
+        return(GeometricMtf(self._system))
+
+class System(_SimObject):
+    def __init__(self):
+        self.LoadFile(None, False)
+
+    def LoadFile(self, filepath, saveIfNeeded):
+        """ Every file is the template system """
+        self._lde = LDE()
+        self._mfe = MFE()
+        self._mce = MCE(backend.nConfigs)
+        self._systemData = SystemData()
+        self._tools = Tools()
+        self._analyses = Analyses(self)
+
+    def Close(self, save):
+        pass
+
+    def SaveAs(self, filepath):
+        backend.saved.append(filepath)
+
+    @property
+    def LDE(self):
+        return(self._lde)
+
+    @property
+    def MFE(self):
+        return(self._mfe)
+
+    @property
+    def MCE(self):
+        return(self._mce)
+
+    @property
+    def SystemData(self):
+        return(self._systemData)
+
+    @property
+    def Tools(self):
+        return(self._tools)
+
+    @property
+    def Analyses(self):
+        return(self._analyses)
+
+class Application(_SimObject):
+    def __init__(self):
+        self.IsValidLicenseForAPI = True
+        self.LicenseStatus = constants.LicenseStatusType_PremiumEdition
+        self.PrimarySystem = System()
+        self.SamplesDir = ''
+        self._process = None
+        if backend.launchProcess:
+            self._process = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(3600)'])
+
+    def CloseApplication(self):
+        if self._process is not None:
+            self._process.kill()
+            self._process.wait()
+            self._process = None
+
+class Connection(_SimObject):
+    def CreateNewApplication(self):
+        application = Application()
+        if application._process is not None:
+            import Watchdog
+            Watchdog.ReportProcess(application._process.pid, os.path.basename(sys.executable))
+        return(application)
+
+def EnsureDispatch(name):
+    return(Connection())
+
+def EnsureModule(name, lcid, major, minor):
+    return(None)
+
+def Install(latency = 0.0, analysisLatency = 0.0, optimizerLatency = 0.0, mfDecay = 0.5, nConfigs = 3, hangOn = None, launchProcess = False):
+    """ Replace win32com with the simulated backend, and return the backend """
+    global backend
+    backend = Backend(latency, analysisLatency, optimizerLatency, mfDecay, nConfigs, hangOn, launchProcess)
+    win32com = types.ModuleType('win32com')
+    client = types.ModuleType('win32com.client')
+    gencache = types.ModuleType('win32com.client.gencache')
+    client.CastTo = CastTo
+    client.constants = constants
+    gencache.EnsureDispatch = EnsureDispatch
+    gencache.EnsureModule = EnsureModule
+    client.gencache = gencache
+    win32com.client = client
+    sys.modules['win32com'] = win32com
+    sys.modules['win32com.client'] = client
+    sys.modules['win32com.client.gencache'] = gencache
+    return(backend)
+
+class SimulatedClock(object):
+    """ Replaces the time module of the scripts. sleep() only adds to the simulated time """
+
+    def __init__(self):
+        self.simulated = 0.0
+
+    def sleep(self, seconds):
+        self.simulated = self.simulated + seconds
+
+    def __getattr__(self, name):
+        return(getattr(time, name))
+
+def SimulatedJob(checkpoint, options, moduleName, functionName, *args):
+    """
+    Watchdog job running moduleName.functionName(checkpoint, *args) on the simulated backend,
+    with the sleeps of the script simulated. options can have
+        hangOn          where the backend hangs, see Backend
+        hangAttempts    the number of attempts that hang, 1 if not given so the replay can finish
+        launchProcess   start a process for every application, see Backend
+    Returns the attempt, the checkpoint it started from, the files it saved and the result of the function.
+    """
+    import Watchdog
+    hangOn = options.get('hangOn')
+    if Watchdog.Attempt() >= options.get('hangAttempts', 1):
+        hangOn = None
+    Install(hangOn = hangOn, launchProcess = options.get('launchProcess', False))
+    module = importlib.import_module(moduleName)
+    module.time = SimulatedClock()
+    result = getattr(module, functionName)(checkpoint, *args)
+    return({'attempt': Watchdog.Attempt(), 'checkpoint': checkpoint, 'saved': backend.saved, 'result': result})
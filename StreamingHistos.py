@@ -0,0 +1,211 @@
+import matplotlib.pyplot as plt
+import json
+import sys
+# Notes
+#
+# Mergeable, constant memory histograms for the Monte Carlo campaigns.
+# Every worker process or campaign run fills its own Histos, saves it with Save(),
+# and the partial results are combined with Merge() without reloading the raw trials.
+# Nothing in here talks to ZOSAPI, so merging and plotting can be done on any machine:
+#
+#       python StreamingHistos.py out-dir/ part1.json part2.json ...
+
+class FixedBinHisto(object):
+    """ Histogram with fixed, equally spaced bins between low and high.
+    Values below low and above high are counted in underflow and overflow.
+    Only the bin counts are kept, so memory does not grow with the number of entries."""
+
+    class BinningException(Exception):
+        pass
+
+    def __init__(self, low, high, nBins):
+        if not high > low or nBins < 1:
+            raise FixedBinHisto.BinningException("Invalid binning " + str((low, high, nBins)))
+        self.low = float(low)
+        self.high = float(high)
+        self.nBins = int(nBins)
+        self.counts = [0] * self.nBins
+        self.underflow = 0
+        self.overflow = 0
+        self.entries = 0
+        self.sum = 0.0
+
+    def BinWidth(self):
+        return((self.high - self.low) / self.nBins)
+
+    def Edges(self):
+        """ The nBins + 1 bin edges """
+        return([self.low + i * self.BinWidth() for i in range(self.nBins + 1)])
+
+    def Fill(self, value, weight = 1):
+        """ Add value to the histogram. The high edge is included in the last bin. """
+        self.entries = self.entries + weight
+        self.sum = self.sum + value * weight
+        if value < self.low:
+            self.underflow = self.underflow + weight
+        elif value > self.high:
+            self.overflow = self.overflow + weight
+        else:
+            index = min(int((value - self.low) / self.BinWidth()), self.nBins - 1)
+            self.counts[index] = self.counts[index] + weight
+
+    def Mean(self):
+        if self.entries == 0:
+            return(0.0)
+        return(self.sum / self.entries)
+
+    def Quantile(self, q):
+        """ Approximate q quantile, interpolating linearly inside the bin.
+        Under- and overflow entries are placed at low and high."""
+        if self.entries == 0:
+            return(0.0)
+        target = q * self.entries
+        seen = self.underflow
+        if target <= seen:
+            return(self.low)
+        for i in range(self.nBins):
+            if seen + self.counts[i] >= target:
+                return(self.low + (i + (target - seen) / self.counts[i]) * self.BinWidth())
+            seen = seen + self.counts[i]
+        return(self.high)
+
+    def Merge(self, other):
+        """ Add the contents of other, which must have the same binning, to this histogram """
+        if (self.low, self.high, self.nBins) != (other.low, other.high, other.nBins):
+            raise FixedBinHisto.BinningException("Can not merge histograms with different binning")
+        for i in range(self.nBins):
+            self.counts[i] = self.counts[i] + other.counts[i]
+        self.underflow = self.underflow + other.underflow
+        self.overflow = self.overflow + other.overflow
+        self.entries = self.entries + other.entries
+        self.sum = self.sum + other.sum
+
+    def Plot(self, fname):
+        """ Draw the binned contents and save the figure to fname """
+        edges = self.Edges()
+        fig,ax = plt.subplots(1,1,figsize=(8,6))
+        plt.hist(edges[:-1], bins=edges, weights=self.counts)
+        plt.grid()
+        fig.savefig(fname)
+        plt.close(fig)
+
+    def ToDict(self):
+        return({'low': self.low, 'high': self.high, 'nBins': self.nBins,
+                'counts': self.counts, 'underflow': self.underflow,
+                'overflow': self.overflow, 'entries': self.entries, 'sum': self.sum})
+
+    @staticmethod
+    def FromDict(d):
+        histo = FixedBinHisto(d['low'], d['high'], d['nBins'])
+        histo.counts = list(d['counts'])
+        histo.underflow = d['underflow']
+        histo.overflow = d['overflow']
+        histo.entries = d['entries']
+        histo.sum = d['sum']
+        return(histo)
+
+class Histos:
+    """ The histograms filled by PlotCentralFieldMTF.
+    resolutions holds the resolution of every data series, histos5, histos75 and histos10
+    hold the number of data series per configuration resolving more than 5, 7.5 and 10 cycles,
+    for tangential, sagittal and average. fields holds the resolution of every field point,
+    keyed by configuration and field coordinates, for ranking the sensitivity of the fields.
+    selection describes the field selection the histograms were filled with, None if the fields were not selected."""
+
+    class MergeException(Exception):
+        pass
+
+    typeNames = ["tangential","sagittal","average"]
+
+    def __init__(self, maxResolution = 20.0, maxCount = 50):
+        self.resolutions = FixedBinHisto(0.0, maxResolution, 80)
+        self.histos5  = [self.CounterHisto(maxCount) for i in range(3)]
+        self.histos75 = [self.CounterHisto(maxCount) for i in range(3)]
+        self.histos10 = [self.CounterHisto(maxCount) for i in range(3)]
+        self.maxResolution = maxResolution
+        self.fields = {}
+        self.selection = None
+
+    def CounterHisto(self, maxCount):
+        """ One bin per integer count from 0 to maxCount """
+        return(FixedBinHisto(-0.5, maxCount + 0.5, maxCount + 1))
+
+    def FillCounterHisto(self, histos, counter):
+        for i in range(3):
+            histos[i].Fill(counter[i])
+
+    def FillField(self, key, resolution):
+        if key not in self.fields:
+            self.fields[key] = FixedBinHisto(0.0, self.maxResolution, 80)
+        self.fields[key].Fill(resolution)
+
+    def PlotHistos(self, path, bname, histos):
+        for i in range(3):
+            histos[i].Plot(path + bname + '-' + self.typeNames[i] + '.png')
+
+    def PlotAll(self, path):
+        """ Make all the summary plots """
+        self.PlotHistos(path, "corners-mtf5",  self.histos5)
+        self.PlotHistos(path, "corners-mtf75", self.histos75)
+        self.PlotHistos(path, "corners-mtf10", self.histos10)
+        self.resolutions.Plot(path + 'mtf-resolution.png')
+
+    def Merge(self, other):
+        """ Add the contents of other, filled with the same field selection, to these histograms """
+        if self.selection != other.selection:
+            raise Histos.MergeException("Can not merge histograms filled with different field selections")
+        self.resolutions.Merge(other.resolutions)
+        for mine, theirs in [(self.histos5, other.histos5), (self.histos75, other.histos75), (self.histos10, other.histos10)]:
+            for i in range(3):
+                mine[i].Merge(theirs[i])
+        for key, histo in other.fields.items():
+            if key in self.fields:
+                self.fields[key].Merge(histo)
+            else:
+                self.fields[key] = FixedBinHisto.FromDict(histo.ToDict())
+
+    def ToDict(self):
+        return({'resolutions': self.resolutions.ToDict(),
+                'histos5':  [h.ToDict() for h in self.histos5],
+                'histos75': [h.ToDict() for h in self.histos75],
+                'histos10': [h.ToDict() for h in self.histos10],
+                'fields': dict((k, h.ToDict()) for k, h in self.fields.items()),
+                'selection': self.selection})
+
+    @staticmethod
+    def FromDict(d):
+        histos = Histos()
+        histos.resolutions = FixedBinHisto.FromDict(d['resolutions'])
+        histos.maxResolution = histos.resolutions.high
+        histos.histos5  = [FixedBinHisto.FromDict(h) for h in d['histos5']]
+        histos.histos75 = [FixedBinHisto.FromDict(h) for h in d['histos75']]
+        histos.histos10 = [FixedBinHisto.FromDict(h) for h in d['histos10']]
+        histos.fields = dict((k, FixedBinHisto.FromDict(h)) for k, h in d.get('fields', {}).items())
+        histos.selection = d.get('selection')
+        return(histos)
+
+    def Save(self, fname):
+        """ Write the partial result to a json file """
+        with open(fname, 'w') as f:
+            json.dump(self.ToDict(), f)
+
+    @staticmethod
+    def Load(fname):
+        with open(fname) as f:
+            return(Histos.FromDict(json.load(f)))
+
+def MergeFiles(fnames):
+    """ Merge the partial results saved in fnames """
+    histos = Histos.Load(fnames[0])
+    for fname in fnames[1:]:
+        histos.Merge(Histos.Load(fname))
+    return(histos)
+
+if __name__ == '__main__':
+    """Merge partial results and make the summary plots. Usage: StreamingHistos.py plotdir part1.json [part2.json ...]"""
+    if len(sys.argv) < 3:
+        print("Usage: StreamingHistos.py plotdir part1.json [part2.json ...]")
+        sys.exit(1)
+    histos = MergeFiles(sys.argv[2:])
+    print("Merged " + str(histos.resolutions.entries) + " resolutions, median is " + str(histos.resolutions.Quantile(0.5)))
+    histos.PlotAll(sys.argv[1])
@@ -0,0 +1,408 @@
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import subprocess
+import sys
+import time
+import traceback
+# Notes
+#
+# Run the ZOSAPI sessions in worker processes, watched for hangs.
+#
+# The scripts call Heartbeat() while they work, and Checkpoint() when a step is done and saved.
+# If a worker does not send a heartbeat before its deadline, for example because a read of
+# CurrentMeritFunction or ApplyAndWaitForCompletion never returns, or if it fails with an exception,
+# only that worker is killed and a new one replays the job from the last checkpoint.
+# Outside of a watched worker Heartbeat() and Checkpoint() do nothing, so the scripts still run on their own.
+#
+# OpticStudio runs in its own process, which is not killed with the python worker. The scripts start
+# OpticStudio with CreateApplication() and close it with CloseApplication(). The watchdog gives the workers
+# turns to start OpticStudio and compares the OpticStudio processes before and after each start, so it knows
+# the PID of the OpticStudio of every worker. That process tree is killed with the worker, so a hung instance
+# does not keep a license seat and its cores. The turns are kept by the watchdog, not by a lock in the workers,
+# so a worker killed while it starts OpticStudio does not block the others.
+#
+# Finished jobs are removed from the checkpoint file, so running a campaign again starts from the beginning.
+# Only an interrupted campaign continues from its checkpoint.
+
+opticStudioImage = 'OpticStudio.exe'
+
+_channel = None
+_attempt = 0
+_launchTurn = None
+
+def Heartbeat(stage, deadline = None):
+    """ Tell the watchdog the worker is alive and in stage. The next heartbeat is expected within
+    deadline seconds, or the default deadline of the watchdog if None."""
+    if _channel is not None:
+        _channel.put(('beat', stage, deadline))
+
+def Checkpoint(state):
+    """ Tell the watchdog the job can be replayed from state, which must be json serializable """
+    if _channel is not None:
+        _channel.put(('checkpoint', state))
+
+def ReportProcess(pid, image = opticStudioImage):
+    """ Tell the watchdog the worker started the process pid, to kill with the worker if it hangs.
+    None tells the watchdog the process was closed."""
+    if _channel is not None:
+        _channel.put(('process', pid, image))
+
+def OpticStudioProcesses():
+    """ Set of the PIDs of the running OpticStudio processes, empty if they can not be listed (not on Windows) """
+    if os.name != 'nt':
+        return(set())
+    try:
+        out = subprocess.check_output(['tasklist', '/FI', 'IMAGENAME eq ' + opticStudioImage, '/FO', 'CSV', '/NH'], universal_newlines = True)
+    except (OSError, subprocess.CalledProcessError):
+        return(set())
+    pids = set()
+    for line in out.splitlines():
+        fields = line.strip().strip('"').split('","')
+        if len(fields) > 1 and fields[1].isdigit():
+            pids.add(int(fields[1]))
+    return(pids)
+
+def CreateApplication(connection):
+    """
+    connection.CreateNewApplication(), in a turn given by the watchdog. The watchdog finds the
+    OpticStudio process started in the turn by comparing the OpticStudio processes before and after.
+    """
+    if _channel is None:
+        return(connection.CreateNewApplication())
+    _channel.put(('launch',))
+    _launchTurn.wait()
+    _launchTurn.clear()
+    try:
+        return(connection.CreateNewApplication())
+    finally:
+        _channel.put(('launched',))
+
+def CloseApplication(application):
+    """ application.CloseApplication(), telling the watchdog the OpticStudio process is gone """
+    application.CloseApplication()
+    ReportProcess(None)
+
+def KillProcessTree(pid, image):
+    """ Kill pid and its children, if it is still a process of image """
+    if os.name == 'nt':
+        try:
+            out = subprocess.check_output(['tasklist', '/FI', 'PID eq ' + str(pid), '/FO', 'CSV', '/NH'], universal_newlines = True)
+            if not out.strip().strip('"').lower().startswith(image.lower()):
+                return
+            subprocess.call(['taskkill', '/F', '/T', '/PID', str(pid)])
+        except (OSError, subprocess.CalledProcessError):
+            pass
+    else:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+def Attempt():
+    """ 0 for the first run of a job, then the number of restarts """
+    return(_attempt)
+
+def _Worker(channel, launchTurn, attempt, function, checkpoint, args):
+    global _channel, _attempt, _launchTurn
+    _channel = channel
+    _launchTurn = launchTurn
+    _attempt = attempt
+    try:
+        result = function(checkpoint, *args)
+        channel.put(('done', result))
+    except Exception:
+        channel.put(('error', traceback.format_exc()))
+
+class Job(object):
+    """ function(checkpoint, *args) is run in a worker. checkpoint is None the first time,
+    then the last state passed to Checkpoint(). """
+
+    def __init__(self, name, function, args = (), checkpoint = None):
+        self.name = name
+        self.function = function
+        self.args = args
+        self.checkpoint = checkpoint
+        self.attempt = 0
+        self.process = None
+        self.channel = None
+        self.launchTurn = None
+        self.application = None
+        self.stage = None
+        self.lastBeat = 0.0
+        self.deadline = 0.0
+        self.done = False
+        self.result = None
+        self.error = None
+
+class SessionWatchdog(object):
+    class JobFailedException(Exception):
+        pass
+
+    def __init__(self, deadline = 900.0, pollInterval = 1.0, maxRestarts = 5, nWorkers = 1, checkpointFile = None, deadlineScale = 1.0):
+        """
+        deadline is the default number of seconds between heartbeats. A job is given up after maxRestarts restarts.
+        Up to nWorkers jobs run at the same time. If checkpointFile is given the checkpoints are saved there,
+        and a campaign that is started again continues from them.
+        Deadlines asked for by the heartbeats are multiplied by deadlineScale, for runs where the sleeps are simulated.
+        """
+        self.deadline = deadline
+        self.pollInterval = pollInterval
+        self.maxRestarts = maxRestarts
+        self.nWorkers = nWorkers
+        self.checkpointFile = checkpointFile
+        self.deadlineScale = deadlineScale
+        self.restarts = 0
+        self.killed = []
+        self.launching = None
+        self.launchQueue = []
+        self.launchBefore = set()
+
+    def LoadCheckpoints(self, jobs):
+        if self.checkpointFile is None or not os.path.exists(self.checkpointFile):
+            return
+        with open(self.checkpointFile) as f:
+            checkpoints = json.load(f)
+        for job in jobs:
+            if job.name in checkpoints:
+                job.checkpoint = checkpoints[job.name]
+                print('Resuming ' + job.name + ' from checkpoint')
+
+    def SaveCheckpoints(self, jobs):
+        """ Save the checkpoints of the unfinished jobs, the file is removed when there are none """
+        if self.checkpointFile is None:
+            return
+        checkpoints = dict((job.name, job.checkpoint) for job in jobs if job.checkpoint is not None and not job.done)
+        if not checkpoints:
+            if os.path.exists(self.checkpointFile):
+                os.remove(self.checkpointFile)
+            return
+        with open(self.checkpointFile + '.tmp', 'w') as f:
+            json.dump(checkpoints, f)
+        os.replace(self.checkpointFile + '.tmp', self.checkpointFile)
+
+    def Start(self, job):
+        job.channel = multiprocessing.Queue()
+        job.launchTurn = multiprocessing.Event()
+        job.process = multiprocessing.Process(target = _Worker, args = (job.channel, job.launchTurn, job.attempt, job.function, job.checkpoint, job.args))
+        job.stage = 'start'
+        job.lastBeat = time.time()
+        job.deadline = self.deadline
+        job.application = None
+        job.process.start()
+
+    def Receive(self, job, jobs):
+        """ Handle the messages from the worker of job """
+        while True:
+            try:
+                message = job.channel.get_nowait()
+            except queue.Empty:
+                return
+            job.lastBeat = time.time()
+            if message[0] == 'beat':
+                job.stage = message[1]
+                job.deadline = self.deadline if message[2] is None else message[2] * self.deadlineScale
+            elif message[0] == 'launch':
+                job.stage = 'CreateApplication'
+                job.deadline = self.deadline
+                self.launchQueue.append(job)
+                self.GrantLaunch()
+            elif message[0] == 'launched':
+                if self.launching is job:
+                    for pid in OpticStudioProcesses() - self.launchBefore:
+                        job.application = (pid, opticStudioImage)
+                    self.launching = None
+                    self.GrantLaunch()
+            elif message[0] == 'process':
+                # The scripts close OpticStudio before starting a new one, only the last one can be left
+                job.application = None if message[1] is None else (message[1], message[2])
+            elif message[0] == 'checkpoint':
+                job.checkpoint = message[1]
+                self.SaveCheckpoints(jobs)
+            elif message[0] == 'done':
+                job.done = True
+                job.result = message[1]
+            elif message[0] == 'error':
+                job.error = message[1]
+
+    def GrantLaunch(self):
+        """ Give the next waiting job the turn to start OpticStudio, if no job has it """
+        if self.launching is not None or not self.launchQueue:
+            return
+        job = self.launchQueue.pop(0)
+        self.launchBefore = OpticStudioProcesses()
+        self.launching = job
+        job.lastBeat = time.time()
+        job.launchTurn.set()
+
+    def Kill(self, job):
+        """ Kill the worker of job, and the OpticStudio it started if the job is not done """
+        if job.process.is_alive():
+            job.process.terminate()
+        job.process.join()
+        applications = []
+        if job.application is not None:
+            applications.append(job.application)
+        if self.launching is job:
+            # Killed while starting OpticStudio, the processes started in the turn are its
+            applications.extend((pid, opticStudioImage) for pid in OpticStudioProcesses() - self.launchBefore)
+            self.launching = None
+        if job in self.launchQueue:
+            self.launchQueue.remove(job)
+        if not job.done:
+            for pid, image in applications:
+                print('Killing ' + image + ' ' + str(pid) + ' started by ' + job.name)
+                KillProcessTree(pid, image)
+                self.killed.append(pid)
+        job.application = None
+        job.channel.close()
+        self.GrantLaunch()
+
+    def Restart(self, job, reason):
+        """ Kill the worker of job and start a new one from the last checkpoint. False if the job is given up """
+        print('Restarting ' + job.name + ' in stage ' + str(job.stage) + ': ' + reason)
+        self.Kill(job)
+        self.restarts = self.restarts + 1
+        job.attempt = job.attempt + 1
+        if job.attempt > self.maxRestarts:
+            print('Giving up ' + job.name + ' after ' + str(self.maxRestarts) + ' restarts')
+            return(False)
+        job.error = None
+        self.Start(job)
+        return(True)
+
+    def Run(self, jobs):
+        """ Run the jobs until they are all done, and return a dict with the result of every job """
+        self.LoadCheckpoints(jobs)
+        pending = list(jobs)
+        running = []
+        failed = []
+        while pending or running:
+            while pending and len(running) < self.nWorkers:
+                job = pending.pop(0)
+                self.Start(job)
+                running.append(job)
+            time.sleep(self.pollInterval)
+            for job in list(running):
+                self.Receive(job, jobs)
+                if job.done:
+                    self.Kill(job)
+                    running.remove(job)
+                    self.SaveCheckpoints(jobs)
+                    continue
+                if job.error is not None:
+                    reason = 'failed with\n' + job.error
+                elif not job.process.is_alive():
+                    self.Receive(job, jobs)
+                    if job.done or job.error is not None:
+                        continue
+                    reason = 'worker exited with code ' + str(job.process.exitcode)
+                elif job in self.launchQueue:
+                    # Waiting for the turn to start OpticStudio
+                    continue
+                elif time.time() - job.lastBeat > job.deadline:
+                    reason = 'no heartbeat for ' + str(job.deadline) + ' seconds'
+                else:
+                    continue
+                if not self.Restart(job, reason):
+                    running.remove(job)
+                    failed.append(job)
+        if failed:
+            raise SessionWatchdog.JobFailedException("Jobs failed: " + ', '.join(job.name for job in failed))
+        return(dict((job.name, job.result) for job in jobs))
+
+def _CheckRestart(workDir):
+    """ The first worker hangs reading CurrentMeritFunction in the third misaligned system, it should be
+    restarted once, from the third system, and only save the systems from there on """
+    from SimulatedZOSAPI import SimulatedJob
+    watchdog = Watchdog.SessionWatchdog(deadline = 5.0, pollInterval = 0.1, checkpointFile = os.path.join(workDir, 'restart.json'), deadlineScale = 0.01)
+    result = watchdog.Run([Watchdog.Job('MC-alignment', SimulatedJob, ({'hangOn': {'Optimizer.CurrentMeritFunction': 30}}, 'MisAlignmentGenerator', 'MisalignCampaign', 0, 5,
+                                                                       os.path.join(workDir, 'tmp2.zmx'), os.path.join(workDir, 'MC-alignment')))])['MC-alignment']
+    assert watchdog.restarts == 1, watchdog.restarts
+    assert result['attempt'] == 1, result
+    assert result['checkpoint'] == 2, result
+    assert result['saved'] == [os.path.join(workDir, 'MC-alignment' + str(i) + '.zmx') for i in range(2, 5)], result['saved']
+    assert not os.path.exists(watchdog.checkpointFile), 'checkpoint file of a finished job left behind'
+
+def _CheckNoDuplicates(workDir):
+    """ The first worker hangs in the MTF analysis of the second file, the replay should give the same
+    histograms as a run without hangs """
+    from SimulatedZOSAPI import SimulatedJob
+    def plot(name, options):
+        watchdog = Watchdog.SessionWatchdog(deadline = 5.0, pollInterval = 0.1, checkpointFile = os.path.join(workDir, name + '.json'), deadlineScale = 0.01)
+        result = watchdog.Run([Watchdog.Job(name, SimulatedJob, (options, 'PlotCentralFieldMTF', 'PlotCampaign', 0, 3,
+                                                                 os.path.join(workDir, 'MC-alignment'), workDir + os.sep))])[name]
+        return(watchdog, result)
+    watchdog, replayed = plot('replayed', {'hangOn': {'GeometricMtf.ApplyAndWaitForCompletion': 4}})
+    assert watchdog.restarts == 1, watchdog.restarts
+    assert replayed['checkpoint']['next'] == 1, replayed['checkpoint']['next']
+    watchdog, reference = plot('reference', {})
+    assert watchdog.restarts == 0, watchdog.restarts
+    for name in ['resolutions', 'histos5', 'histos75', 'histos10', 'fields']:
+        assert replayed['result'][name] == reference['result'][name], name + ' differ after the replay'
+    assert reference['result']['histos5'][0]['entries'] == 3 * 3, reference['result']['histos5'][0]['entries']
+
+def _CheckGiveUp(workDir):
+    """ A job hanging in every attempt should be given up after maxRestarts """
+    from SimulatedZOSAPI import SimulatedJob
+    watchdog = Watchdog.SessionWatchdog(deadline = 5.0, pollInterval = 0.1, maxRestarts = 1, checkpointFile = os.path.join(workDir, 'giveup.json'), deadlineScale = 0.01)
+    try:
+        watchdog.Run([Watchdog.Job('MC-alignment', SimulatedJob, ({'hangOn': {'Optimizer.CurrentMeritFunction': 30}, 'hangAttempts': 10},
+                                                                  'MisAlignmentGenerator', 'MisalignCampaign', 0, 5,
+                                                                  os.path.join(workDir, 'tmp2.zmx'), os.path.join(workDir, 'MC-giveup')))])
+    except Watchdog.SessionWatchdog.JobFailedException:
+        pass
+    else:
+        raise AssertionError('JobFailedException not raised')
+    assert watchdog.restarts == 2, watchdog.restarts
+    assert os.path.exists(watchdog.checkpointFile), 'checkpoint of a failed job removed'
+
+def _CheckLaunchHang(workDir):
+    """ The first worker of one job hangs starting its second OpticStudio. It should be restarted from
+    the second system, without blocking the other job, and the first OpticStudio, which was closed, not killed """
+    from SimulatedZOSAPI import SimulatedJob
+    watchdog = Watchdog.SessionWatchdog(deadline = 5.0, pollInterval = 0.1, nWorkers = 2, checkpointFile = os.path.join(workDir, 'launch.json'), deadlineScale = 0.01)
+    def job(name, options):
+        return(Watchdog.Job(name, SimulatedJob, (options, 'MisAlignmentGenerator', 'MisalignCampaign', 0, 3,
+                                                 os.path.join(workDir, 'tmp2.zmx'), os.path.join(workDir, name))))
+    results = watchdog.Run([job('MC-hung', {'hangOn': {'Connection.CreateNewApplication': 2}, 'launchProcess': True}),
+                            job('MC-other', {'launchProcess': True})])
+    assert watchdog.restarts == 1, watchdog.restarts
+    assert results['MC-hung']['attempt'] == 1 and results['MC-hung']['checkpoint'] == 1, results['MC-hung']
+    assert results['MC-other']['attempt'] == 0, results['MC-other']
+    assert watchdog.killed == [], watchdog.killed
+
+def _Running(pid):
+    """ True if pid is a running process, zombies count as dead (Linux only) """
+    try:
+        with open('/proc/' + str(pid) + '/stat') as f:
+            return(f.read().rsplit(')', 1)[1].split()[0] != 'Z')
+    except (IOError, OSError):
+        return(False)
+
+def _CheckKill(workDir):
+    """ The process standing in for OpticStudio in the hung worker should be killed """
+    from SimulatedZOSAPI import SimulatedJob
+    watchdog = Watchdog.SessionWatchdog(deadline = 5.0, pollInterval = 0.1, checkpointFile = os.path.join(workDir, 'kill.json'), deadlineScale = 0.01)
+    watchdog.Run([Watchdog.Job('MC-alignment', SimulatedJob, ({'hangOn': {'Optimizer.CurrentMeritFunction': 30}, 'launchProcess': True},
+                                                              'MisAlignmentGenerator', 'MisalignCampaign', 0, 5,
+                                                              os.path.join(workDir, 'tmp2.zmx'), os.path.join(workDir, 'MC-kill')))])
+    assert len(watchdog.killed) == 1, watchdog.killed
+    time.sleep(0.5)
+    assert not any(_Running(pid) for pid in watchdog.killed), 'processes still running ' + str(watchdog.killed)
+
+if __name__ == '__main__':
+    """Check the watchdog on the simulated backend"""
+    # The workers must use the same module as the scripts, not __main__
+    import Watchdog
+    import tempfile
+    workDir = tempfile.mkdtemp(prefix = 'watchdog-')
+    checks = [_CheckRestart, _CheckNoDuplicates, _CheckGiveUp, _CheckLaunchHang]
+    if sys.platform.startswith('linux'):
+        checks.append(_CheckKill)
+    for check in checks:
+        start = time.time()
+        check(workDir)
+        print('OK ' + check.__name__ + ' in ' + str(round(time.time() - start, 1)) + ' seconds')